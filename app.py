@@ -1,15 +1,15 @@
 # -*- coding: utf-8 -*-
-import io, re
+import bisect
+import functools
+import html
+import io, json, re, time, unicodedata
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from types import MappingProxyType
 from typing import List, Dict
 
 import streamlit as st
-from pypdf import PdfReader
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import mm
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-from reportlab.lib import colors
 
 from streamlit_option_menu import option_menu
 
@@ -30,54 +30,236 @@ a 5-axis inertial measurement unit, and GaN-based RF front-end suitable for UAV
 }
 
 MATRIX_VERSION = "（デモ）令和7年5月28日施行対応版"
-DEMO_MATRIX_RULES = [
-    (r"\bencrypt(ion|ed|ing)?\b|\bAES\b|\bRSA\b", "5A002", "情報セキュリティ機器", "暗号関連語（AES/RSA/encryption）を検出"),
-    (r"\b(5-axis|5軸|servo|CNC)\b", "2B001", "高精度工作機械", "多軸/サーボ等の高精度語を検出"),
-    (r"\bdrone|UAV|flight controller\b", "9A012", "無人航空機関連", "UAV/ドローン関連語を検出"),
-    (r"\bGaN|InP|GHz\b", "3A001", "高周波半導体/通信", "高周波・化合物半導体を示唆"),
-]
-SANCTIONED_DESTINATIONS = {"北朝鮮":"包括的禁止（デモ）","DPRK":"包括的禁止（デモ）","ロシア":"追加的措置対象（デモ）","イラン":"追加的措置対象（デモ）"}
-DEMO_EUL = {
+# static reference data is frozen (tuples / read-only mappings): it is shared by
+# every Streamlit session in the process, so nothing should be able to mutate it
+# every alternative is anchored as a group: alternation binds looser than \b, so an
+# ungrouped form like \bGaN|InP|GHz\b only anchors the first and last branches
+# and lets the middle ones match inside longer tokens ("minPower" would hit "InP").
+# The 3A001 rule uses a letters-only left lookbehind instead of \b because its
+# tokens are unit-like and legitimately appear digit-attached ("3.2GHz")
+DEMO_MATRIX_RULES = (
+    (r"\b(?:encrypt(?:ion|ed|ing)?|AES|RSA)\b", "5A002", "情報セキュリティ機器", "暗号関連語（AES/RSA/encryption）を検出"),
+    (r"\b(?:5-axis|5軸|servo|CNC)\b", "2B001", "高精度工作機械", "多軸/サーボ等の高精度語を検出"),
+    (r"\b(?:drones?|UAV|flight controller)\b", "9A012", "無人航空機関連", "UAV/ドローン関連語を検出"),
+    (r"(?<![A-Za-z])(?:GaN|InP|GHz)\b", "3A001", "高周波半導体/通信", "高周波・化合物半導体を示唆"),
+)
+# compile once at import: re-parsing the patterns on every Streamlit rerun is pure overhead.
+# All rules are fused into one alternation so the text is scanned a single time,
+# with named groups (r0, r1, ...) telling us which rule fired.
+# IGNORECASE instead of lowering the input: the scan is memoized, so in-scan case
+# folding runs only on cache misses, whereas a .lower() at the callsite would copy
+# the full (PDF-sized) text on every rerun.
+_MATRIX_RULES_RE = re.compile(
+    "|".join(f"(?P<r{i}>{pattern})" for i, (pattern, _, _, _) in enumerate(DEMO_MATRIX_RULES)),
+    re.IGNORECASE,
+)
+SANCTIONED_DESTINATIONS = MappingProxyType({"北朝鮮":"包括的禁止（デモ）","DPRK":"包括的禁止（デモ）","ロシア":"追加的措置対象（デモ）","イラン":"追加的措置対象（デモ）"})
+DEMO_EUL = MappingProxyType({
     # we want visible hits in demo to show “consider license”
     "Acme Research Institute (Xland)": "EUL相当（デモ）：要デューデリ",
     "Orbital Dynamics Lab": "EUL相当（デモ）：要デューデリ",
-}
+})
+END_USE_RED_FLAGS = ("軍事","兵器","ミサイル","核開発","ウラン濃縮","military","weapon","missile","nuclear","warhead")
+
+_TS_CACHE = [0.0, ""]  # (monotonic-ish wall time of last format, formatted string)
+
+def _now_str()->str:
+    # timestamps here are minute precision, but datetime.now().strftime was being
+    # re-run on every rerun/history append; refresh the formatted string at most
+    # every 30s, which can never skip a minute boundary's eventual update
+    t = time.time()
+    if t - _TS_CACHE[0] > 30:
+        _TS_CACHE[:] = [t, datetime.now().strftime("%Y-%m-%d %H:%M")]
+    return _TS_CACHE[1]
+
+def _norm(s:str)->str:
+    # NFKC folds full-width ASCII and half-width kana variants, casefold+strip
+    # absorbs the case and trailing-space typos screening inputs arrive with
+    return unicodedata.normalize("NFKC", s or "").casefold().strip()
+
+# single fused pattern so each party name is scanned once instead of once per EUL entry
+# (real EUL lists run to hundreds of entities); substring match so suffixes still hit.
+# Normalized keys are precomputed once at import, not per click.
+_EUL_RE = re.compile("|".join(re.escape(name) for name in DEMO_EUL), re.IGNORECASE)
+_EUL_BY_NORM = {_norm(name): details for name, details in DEMO_EUL.items()}
+_SANCT_BY_NORM = {_norm(name): details for name, details in SANCTIONED_DESTINATIONS.items()}
+_RED_FLAGS_LOWER = tuple(flag.lower() for flag in END_USE_RED_FLAGS)
+# one fused pattern over the lowered keywords: the 用途 text is scanned once,
+# not once per red-flag entry (no IGNORECASE — screening lowers its input already)
+_RED_FLAG_RE = re.compile("|".join(re.escape(flag) for flag in _RED_FLAGS_LOWER))
+
+# demo risk score: 仕向地 3点 / 相手先 2点ずつ / 懸念語 1点ずつ;
+# the level comes from one bisect over sorted thresholds instead of an if/elif ladder
+_RISK_THRESHOLDS = (1, 3, 6)
+_RISK_LEVELS = ("低", "中", "高", "重大")
 
 # ----------------------------
 # Helpers
 # ----------------------------
+# the classifier only needs enough text to hit its keywords (matches in catalogs
+# cluster near the front), so extraction stops once this budget is reached instead
+# of parsing a 1000-page PDF end to end
+_MAX_SPEC_CHARS = 200_000
+
+# page cap alongside the character budget: a sparse 1000-page catalog could stay
+# under _MAX_SPEC_CHARS forever, so pages bound latency when characters don't
+_MAX_SPEC_PAGES = 50
+
+# pages whose plain extraction comes back shorter than this get a second pass in
+# blocks mode — scanned-ish or heavily boxed layouts sometimes yield near-empty
+# stream-order text while the block list still carries the labels we scan for
+_BLOCKS_FALLBACK_CHARS = 200
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _extract_pdf_text_cached(file_bytes: bytes, max_chars:int=_MAX_SPEC_CHARS, max_pages:int=_MAX_SPEC_PAGES)->str:
+    import fitz  # PyMuPDF — deferred like reportlab, only sessions that upload pay for it
+    parts=[]
+    total=0
+    with fitz.open(stream=file_bytes, filetype="pdf") as doc:
+        for i, page in enumerate(doc):
+            if i >= max_pages:
+                break
+            text = page.get_text()
+            if len(text) < _BLOCKS_FALLBACK_CHARS:
+                # layout-aware retry for low-density pages: sort text blocks by
+                # (y, x) so columns read top-to-bottom instead of stream order
+                blocks = sorted(page.get_text("blocks"), key=lambda b: (b[1], b[0]))
+                block_text = "\n".join(b[4] for b in blocks if b[6] == 0)
+                if len(block_text) > len(text):
+                    text = block_text
+            parts.append(text)
+            total += len(text) + 1
+            if total >= max_chars:
+                break
+    return "\n".join(parts)[:max_chars]
+
 def extract_pdf_text(uploaded_file)->str:
-    if not uploaded_file: return ""
-    r = PdfReader(uploaded_file)
-    return "\n".join([(p.extract_text() or "") for p in r.pages])
+    # empty uploads short-circuit before any byte copy or cache-key hashing
+    if not uploaded_file or not uploaded_file.size: return ""
+    # key the cache on the raw bytes so reruns don't re-parse the same upload
+    return _extract_pdf_text_cached(uploaded_file.getvalue())
+
+def extract_pdf_texts(uploaded_files)->str:
+    if not uploaded_files: return ""
+    if len(uploaded_files) == 1:
+        return extract_pdf_text(uploaded_files[0])
+    # MuPDF releases the GIL inside its C core, so files genuinely parse in parallel;
+    # ex.map preserves upload order for the join
+    with ThreadPoolExecutor(max_workers=4) as ex:
+        return "\n".join(ex.map(extract_pdf_text, uploaded_files))
+
+@functools.lru_cache(maxsize=128)
+def _classify_cached(text:str)->tuple:
+    seen=set()
+    for m in _MATRIX_RULES_RE.finditer(text):
+        seen.add(m.lastgroup)
+        if len(seen) == len(DEMO_MATRIX_RULES):
+            break  # every rule has fired; the rest of the text can't add anything
+    # emit hits in matrix order, not text order, so the result (and the report
+    # table built from it) is stable however the keywords are scattered
+    return tuple(
+        (clause, title, why)
+        for i, (_, clause, title, why) in enumerate(DEMO_MATRIX_RULES)
+        if f"r{i}" in seen
+    )
 
 def toy_classify(text:str)->List[Dict]:
-    hits=[]
-    for pattern, clause, title, why in DEMO_MATRIX_RULES:
-        if re.search(pattern, text, flags=re.IGNORECASE):
-            hits.append({"clause":clause,"title":title,"why":why})
-    return hits
+    # the regex pass is memoized so reruns with unchanged input skip the scan
+    return [{"clause":c,"title":t,"why":w} for c,t,w in _classify_cached(text)]
+
+@functools.lru_cache(maxsize=128)
+def _screen_cached(destination:str, buyer:str, end_user:str, end_use:str)->tuple:
+    def watchlist_flag(name:str):
+        m = _EUL_RE.search(name or "")
+        return _EUL_BY_NORM.get(_norm(m.group())) if m else None
+    use_text = (end_use or "").lower()
+    red_flags = list(dict.fromkeys(_RED_FLAG_RE.findall(use_text)))
+    # a listed entity named inside the free-form 用途 text is a red flag too;
+    # the fused EUL pattern finds them in one pass however long the list grows
+    red_flags += [f"記載企業：{name}" for name in dict.fromkeys(_EUL_RE.findall(end_use or ""))]
+    return (
+        _SANCT_BY_NORM.get(_norm(destination)),
+        watchlist_flag(buyer),
+        watchlist_flag(end_user),
+        tuple(red_flags),
+    )
+
+def screen_transaction(destination:str, buyer:str, end_user:str, end_use:str)->Dict:
+    # memoized on the four input strings: Streamlit reruns the script per widget
+    # change, and most reruns screen the exact same transaction again
+    dest_flag, buyer_flag, end_user_flag, red_flags = _screen_cached(destination, buyer, end_user, end_use)
+    risk_score = 3*bool(dest_flag) + 2*bool(buyer_flag) + 2*bool(end_user_flag) + len(red_flags)
+    return {
+        "destination_flag": dest_flag,
+        "buyer_flag": buyer_flag,
+        "end_user_flag": end_user_flag,
+        "red_flags": list(red_flags),
+        "risk_score": risk_score,
+        "risk_level": _RISK_LEVELS[bisect.bisect_right(_RISK_THRESHOLDS, risk_score)],
+    }
+
+# ReportLab is imported lazily: parsing it costs a noticeable chunk of app start-up,
+# and sessions that never download a report shouldn't pay for it. The stylesheet and
+# the two shared TableStyles are still built only once, on the first report.
+@functools.lru_cache(maxsize=None)
+def _pdf_assets()->Dict:
+    from reportlab.lib import colors
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib.units import mm
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.platypus import TableStyle
+    # touch the fonts once so the AFM metric parse happens here, not mid-build
+    pdfmetrics.getFont("Helvetica")
+    styles = getSampleStyleSheet()
+    styles.add(ParagraphStyle(name="small", fontName="Helvetica", fontSize=9, leading=12))
+    return {
+        "styles": styles,
+        # fixed layout geometry, computed once instead of per report
+        "head_cols": [35*mm, 120*mm],
+        "kv_cols": [40*mm, 115*mm],
+        "hits_cols": [28*mm, 40*mm, 87*mm],
+        "plain": TableStyle([
+            ('BOX',(0,0),(-1,-1),0.6,colors.black),
+            ('INNERGRID',(0,0),(-1,-1),0.3,colors.grey),
+        ]),
+        "headed": TableStyle([
+            ('BACKGROUND',(0,0),(-1,0),colors.whitesmoke),
+            ('BOX',(0,0),(-1,-1),0.6,colors.black),
+            ('INNERGRID',(0,0),(-1,-1),0.3,colors.grey),
+        ]),
+    }
 
 def build_report_pdf(payload:Dict)->bytes:
+    # the payload fully determines the report, so identical payloads (repeat clicks,
+    # autoplay reruns) reuse the cached bytes instead of re-running the ReportLab build.
+    # The 作成日時 header is frozen along with the cached copy, which is fine for a
+    # report whose content hasn't changed.
+    return _build_report_pdf_cached(json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str))
+
+@st.cache_data(show_spinner=False, max_entries=128)
+def _build_report_pdf_cached(payload_json:str)->bytes:
+    return _build_report_pdf(json.loads(payload_json))
+
+def _build_report_pdf(payload:Dict)->bytes:
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.units import mm
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table
+    assets=_pdf_assets()
     buf=io.BytesIO()
     doc=SimpleDocTemplate(
-        buf, pagesize=A4, leftMargin=16*mm, rightMargin=16*mm, topMargin=16*mm, bottomMargin=16*mm
+        buf, pagesize=A4, leftMargin=16*mm, rightMargin=16*mm, topMargin=16*mm, bottomMargin=16*mm,
+        pageCompression=1,  # flate-compress content streams; smaller bytes in session state and over the wire
     )
-    styles=getSampleStyleSheet()
-    styles.add(ParagraphStyle(name="small", fontName="Helvetica", fontSize=9, leading=12))
+    styles=assets["styles"]
     story=[]
     story.append(Paragraph("該非判定書・取引審査レポート（デモ）", styles["Title"]))
     story.append(Spacer(1,6))
 
-    head=[["作成日時", datetime.now().strftime("%Y-%m-%d %H:%M")],
+    head=[["作成日時", _now_str()],
           ["Matrix版", MATRIX_VERSION],
           ["案件ID", payload.get("case_id","-")]]
-    t=Table(head, colWidths=[35*mm,120*mm])
-    t.setStyle(TableStyle([
-        ('BOX',(0,0),(-1,-1),0.6,colors.black),
-        ('INNERGRID',(0,0),(-1,-1),0.3,colors.grey),
-        ('BACKGROUND',(0,0),(-1,0),colors.whitesmoke),
-    ]))
+    t=Table(head, colWidths=assets["head_cols"])
+    t.setStyle(assets["headed"])
     story += [t, Spacer(1,10)]
 
     story.append(Paragraph("1. 物品情報", styles["Heading2"]))
@@ -85,11 +267,8 @@ def build_report_pdf(payload:Dict)->bytes:
         ["品番・製品", payload.get("item_name") or "-"],
         ["HSコード（任意）", payload.get("hs_code") or "-"],
         ["仕様（抜粋）", payload.get("spec_excerpt") or "-"],
-    ], colWidths=[40*mm,115*mm])
-    t2.setStyle(TableStyle([
-        ('BOX',(0,0),(-1,-1),0.6,colors.black),
-        ('INNERGRID',(0,0),(-1,-1),0.3,colors.grey),
-    ]))
+    ], colWidths=assets["kv_cols"])
+    t2.setStyle(assets["plain"])
     story += [t2, Spacer(1,8)]
 
     story.append(Paragraph("2. 取引情報", styles["Heading2"]))
@@ -98,23 +277,16 @@ def build_report_pdf(payload:Dict)->bytes:
         ["エンドユーザー", payload.get("end_user") or "-"],
         ["仕向地", payload.get("destination") or "-"],
         ["用途", payload.get("end_use") or "-"],
-    ], colWidths=[40*mm,115*mm])
-    t3.setStyle(TableStyle([
-        ('BOX',(0,0),(-1,-1),0.6,colors.black),
-        ('INNERGRID',(0,0),(-1,-1),0.3,colors.grey),
-    ]))
+    ], colWidths=assets["kv_cols"])
+    t3.setStyle(assets["plain"])
     story += [t3, Spacer(1,8)]
 
     story.append(Paragraph("3. 該非判定（デモ）", styles["Heading2"]))
     hits=payload.get("hits",[])
     if hits:
         rows=[["候補条項","区分名称","根拠（キーワード）"]]+[[h["clause"],h["title"],h["why"]] for h in hits]
-        t4=Table(rows, colWidths=[28*mm,40*mm,87*mm])
-        t4.setStyle(TableStyle([
-            ('BACKGROUND',(0,0),(-1,0),colors.whitesmoke),
-            ('BOX',(0,0),(-1,-1),0.6,colors.black),
-            ('INNERGRID',(0,0),(-1,-1),0.3,colors.grey),
-        ]))
+        t4=Table(rows, colWidths=assets["hits_cols"])
+        t4.setStyle(assets["headed"])
         story.append(t4)
     else:
         story.append(Paragraph("該当候補は検出されませんでした。", styles["BodyText"]))
@@ -127,12 +299,10 @@ def build_report_pdf(payload:Dict)->bytes:
         ["仕向地", scr.get("destination_flag") or "ヒットなし"],
         ["買主", scr.get("buyer_flag") or "ヒットなし"],
         ["エンドユーザー", scr.get("end_user_flag") or "ヒットなし"],
-    ], colWidths=[40*mm,115*mm])
-    t5.setStyle(TableStyle([
-        ('BACKGROUND',(0,0),(-1,0),colors.whitesmoke),
-        ('BOX',(0,0),(-1,-1),0.6,colors.black),
-        ('INNERGRID',(0,0),(-1,-1),0.3,colors.grey),
-    ]))
+        ["用途（懸念語）", "、".join(scr.get("red_flags") or []) or "ヒットなし"],
+        ["リスクレベル", scr.get("risk_level") or "-"],
+    ], colWidths=assets["kv_cols"])
+    t5.setStyle(assets["headed"])
     story += [t5, Spacer(1,8)]
 
     story.append(Paragraph("5. 総合判断（デモ）", styles["Heading2"]))
@@ -146,8 +316,10 @@ def build_report_pdf(payload:Dict)->bytes:
 # ----------------------------
 # Light theme + left menu styling
 # ----------------------------
-st.set_page_config(page_title="KSA 該非判定・取引先審査（自動デモ）", page_icon="🛡️", layout="wide")
-st.markdown("""
+# module-level constant: the CSS never changes, so the string is built once per
+# process instead of per rerun (st.markdown itself must still run every rerun,
+# otherwise Streamlit drops the style block from the redrawn page)
+_APP_CSS = """
 <style>
 :root{
   --bg:#f7f8fb; --panel:#ffffff; --ink:#0f172a; --muted:#475569;
@@ -162,7 +334,10 @@ button[kind="primary"]{ background:var(--brand) !important; border:0 !important;
 .stTabs [data-baseweb="tab"]{ background:#f2f6fb; border:1px solid var(--border); border-bottom:none; border-radius:10px 10px 0 0; }
 .stTabs [aria-selected="true"]{ background:#fff; color:#0f172a !important; }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+st.set_page_config(page_title="KSA 該非判定・取引先審査（自動デモ）", page_icon="🛡️", layout="wide")
+st.markdown(_APP_CSS, unsafe_allow_html=True)
 
 # ----------------------------
 # Sidebar nav buttons
@@ -194,25 +369,42 @@ st.caption("※ クリック1回で判定→審査→PDF出力まで到達する
 # Unified demo runner
 # ----------------------------
 def run_full_demo():
-    # 1) classification with demo text
-    text = "\n".join([DEMO["spec_text"], DEMO["item_name"], DEMO["key_params"]]).lower()
+    # debounce: with autoplay on this runs on every rerun, and even fully cached
+    # stages still pay cache lookups and a dozen session-state writes. A cheap
+    # digest of the variable inputs lets unchanged reruns return immediately.
+    ss = st.session_state  # single proxy lookup for the whole run
+    inputs_key = (ss.get("case_id", DEMO["case_id"]),
+                  hash(ss.get("uploaded_spec_text", "")))
+    if ss.get("_demo_inputs_key") == inputs_key and ss.get("report_bytes"):
+        return
+
+    # 1) classification with demo text (+ any uploaded spec PDF)
+    uploaded_text = ss.get("uploaded_spec_text", "")
+    text = "\n".join([DEMO["spec_text"], DEMO["item_name"], DEMO["key_params"], uploaded_text])
     hits = toy_classify(text)
 
+    # excerpt for display/report, sliced once here (guarded by the length check so
+    # the common short case allocates nothing) rather than at each consumer
+    spec_full = DEMO["spec_text"] if not uploaded_text else DEMO["spec_text"] + "\n" + uploaded_text
+    spec_excerpt = spec_full if len(spec_full) <= 600 else spec_full[:600] + "…"
+
     # 2) screening with demo parties
-    dest_flag = SANCTIONED_DESTINATIONS.get(DEMO["destination"], None)
-    buyer_flag = DEMO_EUL.get(DEMO["buyer"], None)
-    end_user_flag = DEMO_EUL.get(DEMO["end_user"], None)
+    scr = screen_transaction(DEMO["destination"], DEMO["buyer"], DEMO["end_user"], DEMO["end_use"])
+    dest_flag = scr["destination_flag"]
+    buyer_flag = scr["buyer_flag"]
+    end_user_flag = scr["end_user_flag"]
+    red_flags = scr["red_flags"]
 
-    needs_license = bool(hits) or bool(dest_flag) or bool(buyer_flag) or bool(end_user_flag)
+    needs_license = bool(hits) or bool(dest_flag) or bool(buyer_flag) or bool(end_user_flag) or bool(red_flags)
     decision_text = ("【デモ】要ライセンス検討：仕向地/相手先のリスク、またはリスト該当候補あり。"
                      if needs_license else
                      "【デモ】現時点ではライセンス不要の可能性。ただし用途・最終需要者の適正性確認が必要。")
 
     # cache in state
-    st.session_state.update({
+    ss.update({
         "item_name": DEMO["item_name"],
         "hs_code": DEMO["hs_code"],
-        "spec_excerpt": DEMO["spec_text"],
+        "spec_excerpt": spec_excerpt,
         "hits": hits,
         "destination": DEMO["destination"],
         "buyer": DEMO["buyer"],
@@ -221,15 +413,18 @@ def run_full_demo():
         "dest_flag": dest_flag,
         "buyer_flag": buyer_flag,
         "end_user_flag": end_user_flag,
+        "red_flags": red_flags,
+        "risk_score": scr["risk_score"],
+        "risk_level": scr["risk_level"],
         "decision_text": decision_text
     })
 
     # 3) build report
     report_bytes = build_report_pdf({
-        "case_id": st.session_state.get("case_id", "DEMO"),
+        "case_id": ss.get("case_id", "DEMO"),
         "item_name": DEMO["item_name"],
         "hs_code": DEMO["hs_code"],
-        "spec_excerpt": DEMO["spec_text"],
+        "spec_excerpt": spec_excerpt,
         "buyer": DEMO["buyer"],
         "end_user": DEMO["end_user"],
         "destination": DEMO["destination"],
@@ -239,10 +434,13 @@ def run_full_demo():
             "destination_flag": dest_flag,
             "buyer_flag": buyer_flag,
             "end_user_flag": end_user_flag,
+            "red_flags": red_flags,
+            "risk_level": scr["risk_level"],
         },
         "decision_text": decision_text
     })
-    st.session_state["report_bytes"] = report_bytes
+    ss["report_bytes"] = report_bytes
+    ss["_demo_inputs_key"] = inputs_key
 
 # auto play if toggled
 if st.session_state.get("autoplay", False):
@@ -262,6 +460,22 @@ if choice == "01 該非判定":
             c1.text_input("HSコード（任意）", value=DEMO["hs_code"])
             c2.text_input("主な性能（任意）", value=DEMO["key_params"])
             st.text_area("仕様テキスト（参考）", DEMO["spec_text"], height=120)
+            uploaded_pdfs = st.file_uploader("仕様書PDF（任意・複数可）", type=["pdf"], accept_multiple_files=True)
+            # re-extract only when the set of uploads changes: even the cached path
+            # pays a getvalue() byte copy per file on every rerun otherwise
+            upload_ids = tuple(f.file_id for f in uploaded_pdfs) if uploaded_pdfs else ()
+            if st.session_state.get("uploaded_pdf_ids") != upload_ids:
+                st.session_state["uploaded_pdf_ids"] = upload_ids
+                st.session_state["uploaded_spec_text"] = extract_pdf_texts(uploaded_pdfs)
+                # autoplay already ran at the top of this rerun, before the new text
+                # existed — run again so the hit cards below actually include it
+                # (the inputs-key debounce makes this a no-op on every other rerun)
+                if st.session_state.get("autoplay", False):
+                    run_full_demo()
+            if st.session_state["uploaded_spec_text"]:
+                st.caption("PDFから仕様テキストを取り込みました（判定に追加されます）。")
+                if len(st.session_state["uploaded_spec_text"]) >= _MAX_SPEC_CHARS:
+                    st.caption(f"※ 先頭 約{_MAX_SPEC_CHARS//1000}K文字のみ解析対象")
             st.markdown('</div>', unsafe_allow_html=True)
 
             st.button("🔎 デモを即実行", type="primary", on_click=run_full_demo)
@@ -269,8 +483,12 @@ if choice == "01 該非判定":
             st.markdown("#### 判定候補（デモ）")
             hits = st.session_state.get("hits", [])
             if hits:
-                for h in hits:
-                    st.markdown(f'<div class="card">🧩 <b>{h["clause"]}</b> / {h["title"]}<br/><span class="badge">{h["why"]}</span></div>', unsafe_allow_html=True)
+                # one markdown element for all cards: each st.markdown is a separate
+                # Streamlit protocol message, so batching cuts per-rerun round-trips
+                st.markdown("".join(
+                    f'<div class="card">🧩 <b>{h["clause"]}</b> / {h["title"]}<br/><span class="badge">{h["why"]}</span></div>'
+                    for h in hits
+                ), unsafe_allow_html=True)
             else:
                 st.info("右上の『デモを即実行』をクリックしてください。")
 
@@ -301,55 +519,67 @@ elif choice == "02 取引先審査":
     with colB:
         st.markdown('<div class="card">', unsafe_allow_html=True)
         st.subheader("審査結果（デモ）")
-        if "decision_text" in st.session_state:
-            st.write("**総合判断**：", st.session_state["decision_text"])
-            st.write("・仕向地：", st.session_state.get("dest_flag") or "ヒットなし")
-            st.write("・買主：", st.session_state.get("buyer_flag") or "ヒットなし")
-            st.write("・エンドユーザー：", st.session_state.get("end_user_flag") or "ヒットなし")
+        ss = st.session_state  # one proxy lookup for the whole card, not one per field
+        if "decision_text" in ss:
+            st.write("**総合判断**：", ss["decision_text"])
+            st.write("・仕向地：", ss.get("dest_flag") or "ヒットなし")
+            st.write("・買主：", ss.get("buyer_flag") or "ヒットなし")
+            st.write("・エンドユーザー：", ss.get("end_user_flag") or "ヒットなし")
+            st.write("・用途（懸念語）：", "、".join(ss.get("red_flags") or []) or "ヒットなし")
+            st.write("・リスクレベル：", ss.get("risk_level") or "-")
             st.write("・Matrix版：", MATRIX_VERSION)
         else:
             st.caption("左のボタンでデモを実行してください。")
         st.markdown('</div>', unsafe_allow_html=True)
 
-        st.markdown('<div class="card">', unsafe_allow_html=True)
-        if st.session_state.get("report_bytes"):
-            st.download_button(
-                "⬇️ 該非判定書＋審査票（PDF）をダウンロード",
-                st.session_state["report_bytes"],
-                file_name=f"{st.session_state.get('case_id','DEMO')}_report.pdf",
-                mime="application/pdf",
-                use_container_width=True
-            )
-        else:
-            st.info("上の『デモ審査を再実行』またはサイドバーの自動再生をONにしてください。")
-        st.markdown('</div>', unsafe_allow_html=True)
+        # fragment: clicking the download button reruns only this card,
+        # not the classification/screening path for the whole page
+        @st.fragment
+        def _report_download_card():
+            st.markdown('<div class="card">', unsafe_allow_html=True)
+            if st.session_state.get("report_bytes"):
+                st.download_button(
+                    "⬇️ 該非判定書＋審査票（PDF）をダウンロード",
+                    st.session_state["report_bytes"],
+                    file_name=f"{st.session_state.get('case_id','DEMO')}_report.pdf",
+                    mime="application/pdf",
+                    use_container_width=True
+                )
+            else:
+                st.info("上の『デモ審査を再実行』またはサイドバーの自動再生をONにしてください。")
+            st.markdown('</div>', unsafe_allow_html=True)
+        _report_download_card()
 
 # ----------------------------
 # Page: 03 過去履歴 (simple, auto-add when user downloads)
 # ----------------------------
 elif choice == "03 過去履歴":
     st.subheader("過去履歴（デモ）")
-    hist = st.session_state.get("history", [])
+    # bounded deque, newest first: appendleft is O(1), maxlen caps memory over a
+    # long session, and rendering needs no reversed() pass
+    hist = st.session_state.setdefault("history", deque(maxlen=100))
     if not hist and st.session_state.get("decision_text"):
         # seed one history row so it isn't empty in demo
-        hist = [{
-            "time": datetime.now().strftime("%Y-%m-%d %H:%M"),
+        hist.appendleft({
+            "time": _now_str(),
             "case_id": st.session_state.get("case_id","DEMO"),
             "item": DEMO["item_name"],
             "dest": DEMO["destination"],
             "decision": st.session_state.get("decision_text")
-        }]
-        st.session_state["history"] = hist
+        })
 
     if not hist:
         st.info("まだ履歴はありません。『01→02』の順でデモ実行してください。")
     else:
-        for row in reversed(hist):
-            st.markdown(
-                f'<div class="card"><b>{row["time"]}</b> ｜ 案件ID：<code>{row["case_id"]}</code><br/>'
-                f'物品：{row["item"]} ／ 仕向地：{row["dest"]}<br/>判断：{row["decision"]}</div>',
-                unsafe_allow_html=True
-            )
+        # one markdown element for the whole list: per-row st.markdown calls cost a
+        # protocol message and a DOM element each, every rerun
+        # case_id comes from a free text input, so escape row fields before they
+        # land in an unsafe_allow_html block
+        st.markdown("".join(
+            f'<div class="card"><b>{html.escape(row["time"])}</b> ｜ 案件ID：<code>{html.escape(row["case_id"])}</code><br/>'
+            f'物品：{html.escape(row["item"])} ／ 仕向地：{html.escape(row["dest"])}<br/>判断：{html.escape(row["decision"])}</div>'
+            for row in hist
+        ), unsafe_allow_html=True)
 
 # ----------------------------
 # Page: 04 問合せ
@@ -357,12 +587,18 @@ elif choice == "03 過去履歴":
 else:
     st.subheader("問合せ")
     st.write("導入・PoC・追加機能に関するご相談はこちら。")
-    a,b = st.columns(2)
-    with a:
-        st.text_input("お名前", value="山田 太郎")
-        st.text_input("メールアドレス", value="demo@example.com")
-    with b:
-        st.text_input("会社名（任意）", value="KSA International")
-        st.text_input("電話番号（任意）", value="03-0000-0000")
-    st.text_area("ご相談内容", value="デモ拝見。実機連携と料金プランについて相談したい。", height=120)
-    st.button("📩 送信（ダミー）", type="primary")
+
+    # fragment: edits to the contact fields rerun only this form, not the whole
+    # script (which, with autoplay on, walks the demo pipeline again)
+    @st.fragment
+    def _inquiry_form():
+        a,b = st.columns(2)
+        with a:
+            st.text_input("お名前", value="山田 太郎")
+            st.text_input("メールアドレス", value="demo@example.com")
+        with b:
+            st.text_input("会社名（任意）", value="KSA International")
+            st.text_input("電話番号（任意）", value="03-0000-0000")
+        st.text_area("ご相談内容", value="デモ拝見。実機連携と料金プランについて相談したい。", height=120)
+        st.button("📩 送信（ダミー）", type="primary")
+    _inquiry_form()